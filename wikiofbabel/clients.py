@@ -1,16 +1,28 @@
+import asyncio
 import os
 from typing import Annotated
 
+import httpx
 from fastapi import Depends
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+# Keep connections to the OpenAI endpoint alive between the article and
+# summary calls instead of paying a TCP+TLS handshake for each of them.
+http_client = DefaultAsyncHttpxClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+)
+
+# Cap the number of in-flight OpenAI completions: without it a burst of
+# cache-misses opens one request per client and everything trips 429s.
+OAI_SEM = asyncio.Semaphore(int(os.getenv("OAI_MAX_CONCURRENCY", "8")))
 
 envfile = os.path.expanduser("~/.openai")
 if os.path.isfile(envfile):
     with open(os.path.expanduser("~/.openai"), encoding="utf-8") as fd:
         key = fd.read().strip()
-        oai_client = AsyncOpenAI(api_key=key)
+        oai_client = AsyncOpenAI(api_key=key, http_client=http_client)
 else:
-    oai_client = AsyncOpenAI()
+    oai_client = AsyncOpenAI(http_client=http_client)
 
 
 def get_oaiclient():
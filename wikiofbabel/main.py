@@ -1,37 +1,96 @@
+import asyncio
+import functools
+import hashlib
 import logging
 import re
 from typing import List
 
-import markdown
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+import cmarkgfm
+from async_lru import alru_cache
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+from openai import RateLimitError
 from sqlalchemy import func, select
+from sqlalchemy.orm import load_only
 from sqlalchemy.sql import text
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
 
 from wikiofbabel.clients import AsyncOpenAI
 
-from .clients import OAIClient
-from .db import DbSession
+from .clients import OAI_SEM, OAIClient, oai_client
+from .db import DbSession, SessionLocal
 from .db import engine as db_engine
 from .models import Article, WikiBase
+from .summaries import summary_worker
 
 log = logging.getLogger(__name__)
 
-
-def lifespan(_app: FastAPI):
-    WikiBase.metadata.create_all(bind=db_engine)
+WIKI_LINK_RE = re.compile(r"\[\[(.*?)\]\]")
+KEYWORD_RE = re.compile(r"[^a-zA-Z0-9\s]")
+
+# One lock per keyword being generated, so two browsers asking for the same
+# missing page only pay for one gpt-4o call (and don't race on the insert).
+# setdefault is atomic on the event loop, no extra locking needed.
+GENERATION_LOCKS: dict[str, asyncio.Lock] = {}
+
+
+def generation_lock(keyword: str) -> asyncio.Lock:
+    return GENERATION_LOCKS.setdefault(keyword, asyncio.Lock())
+
+
+def article_etag(content: str) -> str:
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+
+async def lifespan(_app: FastAPI):
+    async with db_engine.begin() as conn:
+        # When gunicorn forks several workers, only the first one to grab the
+        # advisory lock runs the DDL; the others would just queue up on the
+        # same table locks for nothing.
+        acquired = (
+            await conn.execute(text("SELECT pg_try_advisory_lock(4242)"))
+        ).scalar()
+        if acquired:
+            try:
+                await conn.run_sync(WikiBase.metadata.create_all)
+                # create_all does not touch an existing table: add the
+                # columns introduced since the original schema so databases
+                # created by older versions keep working
+                await conn.execute(
+                    text(
+                        "ALTER TABLE articles "
+                        "ADD COLUMN IF NOT EXISTS rendered_html TEXT, "
+                        "ADD COLUMN IF NOT EXISTS etag VARCHAR"
+                    )
+                )
+                # Used by /random to sample a single row in O(1)
+                await conn.execute(
+                    text("CREATE EXTENSION IF NOT EXISTS tsm_system_rows")
+                )
+            finally:
+                await conn.execute(text("SELECT pg_advisory_unlock(4242)"))
+    worker = asyncio.create_task(summary_worker(oai_client))
     yield
+    worker.cancel()
 
 
 app = FastAPI(title="Infinite Library", lifespan=lifespan)
 
 
-async def generate_article(keyword: str, db: DbSession, oai_client: AsyncOpenAI) -> str:
+async def generate_article(
+    keyword: str, related_articles: List[Article], oai_client: AsyncOpenAI
+):
     """
     Generate an article using ChatGPT with context from related articles.
+    Yields the completion text as it is produced so the response can be
+    streamed to the client instead of blocking on the full 2000 tokens.
     """
     log.info("Generating article for %s", keyword)
-    related_articles = await find_related_articles(keyword, db)
     log.info("Found %d related articles", len(related_articles))
     context = create_context_summary(related_articles)
 
@@ -60,43 +119,79 @@ The article should include:
 
 Format the article in markdown."""
 
-    response = await oai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.7,  # Balanced between creativity and consistency
-        max_tokens=2000,  # Adjust based on desired article length
-        presence_penalty=0.6,  # Encourage mentioning new concepts
-        frequency_penalty=0.6,  # Discourage repetition
+    async with OAI_SEM:
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception_type(RateLimitError),
+            wait=wait_exponential_jitter(1, 30),
+            stop=stop_after_attempt(6),
+            reraise=True,
+        ):
+            with attempt:
+                stream = await oai_client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_prompt},
+                    ],
+                    temperature=0.7,  # Balanced between creativity and consistency
+                    max_tokens=2000,  # Adjust based on desired article length
+                    presence_penalty=0.6,  # Encourage mentioning new concepts
+                    frequency_penalty=0.6,  # Discourage repetition
+                    stream=True,
+                )
+
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+async def lookup_article(keyword: str, db: DbSession) -> Article | None:
+    """
+    Fetch an existing article by keyword, or None if it was never generated.
+    """
+    # keyword is the primary key: session.get uses the identity map and a
+    # cached SELECT instead of compiling a fresh query every time. Only the
+    # columns needed to serve the page are fetched; content, summary and the
+    # tsvector stay in Postgres.
+    return await db.get(
+        Article,
+        keyword,
+        options=[load_only(Article.keyword, Article.rendered_html, Article.etag)],
     )
 
-    return response.choices[0].message.content
 
-
-async def find_related_articles(
-    keyword: str, db: DbSession, max_articles: int = 3
-) -> List[Article]:
+@alru_cache(maxsize=2048, ttl=60)
+async def find_related_articles(keyword: str, max_articles: int = 3) -> List[Article]:
     """
     Find related articles using PostgreSQL full-text search.
     Returns a list of the most relevant articles.
+
+    Runs on its own session so it can be scheduled concurrently with the
+    lookup on the request session. Cached so a keyword hammered while its
+    article is still being generated only costs one FTS scan; the cache is
+    cleared whenever a new article lands.
     """
-    # Create tsquery from keyword
-    searched_words = " | ".join(keyword.split())
+    # websearch_to_tsquery never raises on odd input, unlike a hand-built
+    # to_tsquery expression where a stray operator is a syntax error. The
+    # CTE makes Postgres parse the query text once instead of once per
+    # place it is used (the rank and the match).
+    tsq = select(func.websearch_to_tsquery("english", keyword).label("tsq")).cte("q")
 
-    rank_cd = func.ts_rank_cd(
-        Article.words, func.to_tsquery("english", searched_words)
-    ).label("rank")
+    rank_cd = func.ts_rank_cd(Article.words, tsq.c.tsq).label("rank")
 
     query = (
-        select(Article.keyword, Article.content, rank_cd)
-        .where(Article.words.bool_op("@@")(func.to_tsquery("english", searched_words)))
+        select(Article.keyword, Article.summary, rank_cd)
+        .select_from(Article, tsq)
+        .where(Article.words.bool_op("@@")(tsq.c.tsq))
+        # Articles still waiting on the batch summary worker have nothing to
+        # contribute to the context yet
+        .where(Article.summary.is_not(None))
         .order_by(rank_cd.desc())
         .limit(max_articles)
     )
 
-    return list(db.execute(query))
+    async with SessionLocal() as session:
+        return list(await session.execute(query))
 
 
 def create_context_summary(related_articles: List[Article]) -> str:
@@ -106,34 +201,16 @@ def create_context_summary(related_articles: List[Article]) -> str:
     if not related_articles:
         return "No related articles found."
 
-    summary = "Related articles in our encyclopedia:\n\n"
-    for article in related_articles:
-        summary += f"From article about {article.keyword}:\n{summary}\n\n"
-
-    return summary
-
-
-async def generate_summary(content: str, oai_client: AsyncOpenAI):
-    response = await oai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {
-                "role": "system",
-                "content": """You are a summary generator for a full text search engine. You will summarise each
-                message in less than 100 words. The messages are wiki articles. You should only output the summary.
-                Please try to retain as many keywords as possible from the original text.
-             """,
-            },
-            {"role": "user", "content": content},
-        ],
-        temperature=0.7,  # Balanced between creativity and consistency
-        max_tokens=2000,  # Adjust based on desired article length
+    parts = ["Related articles in our encyclopedia:\n"]
+    parts.extend(
+        f"From article about {article.keyword}:\n{article.summary}\n"
+        for article in related_articles
     )
 
-    return response.choices[0].message.content
+    return "\n".join(parts)
 
 
-def process_markdown(content: str) -> str:
+def _process_markdown(content: str) -> str:
     """
     Convert markdown to HTML and process wiki-style links.
     """
@@ -143,32 +220,45 @@ def process_markdown(content: str) -> str:
         url_name = page_name.replace(" ", "_")
         return f'<a href="/{url_name}">{page_name}</a>'
 
-    content = re.sub(r"\[\[(.*?)\]\]", wiki_link_replacer, content)
-    return markdown.markdown(content)
+    # The [[links]] are replaced before the conversion. CMARK_OPT_UNSAFE is
+    # needed so the raw HTML anchors survive (cmark strips raw HTML by
+    # default); the GFM tagfilter still removes <script> and friends, which
+    # matches what the old python-markdown renderer accepted.
+    content = WIKI_LINK_RE.sub(wiki_link_replacer, content)
+    return cmarkgfm.github_flavored_markdown_to_html(
+        content, options=cmarkgfm.cmark.Options.CMARK_OPT_UNSAFE
+    )
+
+
+async def process_markdown(content: str) -> str:
+    """
+    Render markdown in a worker thread: even with the C parser a long
+    article is CPU-bound work that would otherwise sit on the event loop.
+    """
+    return await asyncio.to_thread(_process_markdown, content)
 
 
 @app.get("/random")
 async def get_random_article(db: DbSession):
-    # We try different sampling rates until we get a match
-    for rate in [1, 10, 50, 75, 90, 100]:
-        print(rate)
-        result = db.execute(
-            # Not random at all, but you ge the idea
-            text(f"SELECT keyword FROM articles TABLESAMPLE BERNOULLI ({rate}) limit 1")
-        ).first()
-        if result is not None:
-            break
+    # SYSTEM_ROWS picks exactly one row in O(1), whatever the table size
+    result = (
+        await db.execute(
+            text("SELECT keyword FROM articles TABLESAMPLE SYSTEM_ROWS(1)")
+        )
+    ).first()
     if result is None:
         return HTMLResponse(
             content=render_content(
-                "Nowhere", "Do you want to try something? Like [[The great Emu War]]"
+                "Nowhere",
+                await process_markdown(
+                    "Do you want to try something? Like [[The great Emu War]]"
+                ),
             )
         )
     return RedirectResponse(url="/" + result[0].replace(" ", "_"))
 
 
-def render_content(title: str, content: str):
-    html_content = process_markdown(content)
+def page_head(title: str) -> str:
     return f"""
     <!DOCTYPE html>
     <html>
@@ -185,8 +275,10 @@ def render_content(title: str, content: str):
             </style>
         </head>
         <body>
-            {html_content}
+    """
+
 
+PAGE_FOOT = """
             <hr>
             <i><a href="/random">Random page</a>
         </body>
@@ -194,12 +286,23 @@ def render_content(title: str, content: str):
     """
 
 
+@functools.lru_cache(maxsize=1024)
+def render_content(title: str, html_content: str):
+    return page_head(title) + html_content + PAGE_FOOT
+
+
 @app.get("/")
 async def page_list(db: DbSession):
-    articles = db.query(Article).limit(50)
+    # Only the keywords are needed for the links: pulling content/summary and
+    # the tsvector for 50 rows would dwarf the rest of the endpoint
+    keywords = (
+        await db.execute(select(Article.keyword).order_by(Article.keyword).limit(50))
+    ).scalars()
     main = "# The infinite library\n\nYou can go anywhere and we will auto-generate a new page for every keywords\n\n## The first 50 pages:\n"
-    content = main + "\n".join("- [[" + a.keyword + "]]" for a in articles)
-    return HTMLResponse(content=render_content("The infinite Library", content))
+    content = main + "\n".join("- [[" + keyword + "]]" for keyword in keywords)
+    return HTMLResponse(
+        content=render_content("The infinite Library", await process_markdown(content))
+    )
 
 
 @app.get("/favicon.ico")
@@ -208,23 +311,102 @@ async def favicon():
 
 
 @app.get("/{keyword}")
-async def get_article(keyword: str, db: DbSession, oai_client: OAIClient):
+async def get_article(
+    keyword: str, request: Request, db: DbSession, oai_client: OAIClient
+):
     # Very simplistic keyword conversion: _ become spaces, any other non-alphanumerical character
     # is ignored
     keyword = keyword.replace("_", " ")
-    keyword = re.sub(r"[^a-zA-Z0-9\s]", "", keyword).strip()
+    keyword = KEYWORD_RE.sub("", keyword).strip()
     if not keyword:
         raise HTTPException(status_code=400, detail="Invalid keyword")
 
-    article = db.query(Article).filter(Article.keyword == keyword).first()
-
-    if not article:
-        content = await generate_article(keyword, db, oai_client)
-        summary = await generate_summary(content, oai_client)
+    # Optimistically prefetch the related articles while we check for an
+    # existing one: on a miss the context is already there, and the FTS lookup
+    # is cheap compared to the two OpenAI round-trips we are about to make.
+    article, related_articles = await asyncio.gather(
+        lookup_article(keyword, db),
+        find_related_articles(keyword),
+    )
 
-        article = Article(keyword=keyword, content=content, summary=summary)
-        db.add(article)
-        db.commit()
-        db.refresh(article)
+    if article:
+        if article.rendered_html is None or article.etag is None:
+            # Article from before these columns existed: backfill. content
+            # is deferred by lookup_article, so load it explicitly
+            await db.refresh(article, ["content"])
+            article.rendered_html = await process_markdown(article.content)
+            article.etag = article_etag(article.content)
+            await db.commit()
+
+        # Articles are immutable, so let browsers and CDNs serve them from
+        # their own cache whenever possible
+        etag = f'"{article.etag}"'
+        headers = {
+            "Cache-Control": "public, max-age=86400, stale-while-revalidate=604800",
+            "ETag": etag,
+        }
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return HTMLResponse(
+            content=render_content(article.keyword, article.rendered_html),
+            headers=headers,
+        )
 
-    return HTMLResponse(content=render_content(article.keyword, article.content))
+    async def stream_article():
+        try:
+            async with generation_lock(keyword):
+                # Someone may have generated the article while we waited for
+                # the lock: serve it instead of paying for a duplicate
+                async with SessionLocal() as session:
+                    existing = await session.get(Article, keyword)
+                    if existing is not None and existing.rendered_html is None:
+                        # Same backfill as the hit path, for rows from
+                        # before rendered_html existed
+                        existing.rendered_html = await process_markdown(
+                            existing.content
+                        )
+                        existing.etag = article_etag(existing.content)
+                        await session.commit()
+                if existing is not None:
+                    yield render_content(existing.keyword, existing.rendered_html)
+                    return
+
+                # Show the raw markdown as it is generated, then reload to
+                # get the stored, properly rendered version. Much nicer than
+                # 20s of blank page.
+                yield page_head(keyword)
+                yield (
+                    "<p><i>This article is being written for you, the rendered page "
+                    'will load when it is done...</i></p><pre style="white-space: pre-wrap">'
+                )
+                chunks = []
+                async for delta in generate_article(
+                    keyword, related_articles, oai_client
+                ):
+                    chunks.append(delta)
+                    yield delta
+                content = "".join(chunks)
+
+                # The request session may be gone by the time the stream
+                # finishes, so the insertion gets its own. The summary is
+                # only used for full-text search and is filled in later by
+                # the summary_worker through the (cheaper) Batch API.
+                async with SessionLocal() as session:
+                    session.add(
+                        Article(
+                            keyword=keyword,
+                            content=content,
+                            rendered_html=await process_markdown(content),
+                            etag=article_etag(content),
+                            summary=None,
+                        )
+                    )
+                    await session.commit()
+                find_related_articles.cache_clear()
+        finally:
+            GENERATION_LOCKS.pop(keyword, None)
+
+        yield "</pre><script>location.reload()</script>"
+        yield PAGE_FOOT
+
+    return StreamingResponse(stream_article(), media_type="text/html")
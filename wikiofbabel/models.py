@@ -12,6 +12,11 @@ class Article(WikiBase):
 
     keyword = Column(String, primary_key=True, index=True)
     content = Column(Text)
+    # content is immutable once written, so its HTML rendering is done once
+    # at insertion time and stored here instead of on every GET
+    rendered_html = Column(Text)
+    # content hash served as the ETag header, computed at insertion time
+    etag = Column(String)
     summary = Column(Text)
     words = Column(
         TSVECTOR, Computed("to_tsvector('english', keyword || ' ' || content)")
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import logging
+import os
+
+from openai import AsyncOpenAI
+from sqlalchemy import select
+
+from .db import SessionLocal
+from .models import Article
+
+log = logging.getLogger(__name__)
+
+SUMMARY_SYSTEM_PROMPT = """You are a summary generator for a full text search engine. You will summarise each
+message in less than 100 words. The messages are wiki articles. You should only output the summary.
+Please try to retain as many keywords as possible from the original text.
+"""
+
+# Summaries are only read by the full-text-search indexer, never by a user, so
+# there is no rush: we sweep for missing ones every BATCH_INTERVAL seconds and
+# send them through the Batch API at half the realtime token price.
+BATCH_INTERVAL = int(os.getenv("SUMMARY_BATCH_INTERVAL", "300"))
+POLL_INTERVAL = 60
+
+
+async def pending_articles() -> list[tuple[str, str]]:
+    """
+    Articles inserted by the request path with no summary yet.
+    """
+    async with SessionLocal() as session:
+        query = select(Article.keyword, Article.content).where(
+            Article.summary.is_(None)
+        )
+        return [(row.keyword, row.content) for row in await session.execute(query)]
+
+
+def build_batch_file(articles: list[tuple[str, str]]) -> bytes:
+    """
+    Serialize one chat.completions request per article in the JSONL format
+    expected by the Batch API. The keyword doubles as the custom_id so the
+    results can be matched back to their row.
+    """
+    lines = []
+    for keyword, content in articles:
+        lines.append(
+            json.dumps(
+                {
+                    "custom_id": keyword,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": "gpt-4o",
+                        "messages": [
+                            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                            {"role": "user", "content": content},
+                        ],
+                        "temperature": 0.7,
+                        "max_tokens": 2000,
+                    },
+                }
+            )
+        )
+    return "\n".join(lines).encode("utf-8")
+
+
+async def save_summaries(output: str):
+    async with SessionLocal() as session:
+        for line in output.splitlines():
+            result = json.loads(line)
+            keyword = result["custom_id"]
+            response = result["response"]
+            if response["status_code"] != 200:
+                log.warning("Summary for %s failed: %s", keyword, response)
+                continue
+            article = await session.get(Article, keyword)
+            if article is not None:
+                article.summary = response["body"]["choices"][0]["message"]["content"]
+        await session.commit()
+
+
+async def run_batch(oai_client: AsyncOpenAI, articles: list[tuple[str, str]]):
+    batch_file = await oai_client.files.create(
+        file=("summaries.jsonl", build_batch_file(articles)), purpose="batch"
+    )
+    batch = await oai_client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    log.info("Submitted summary batch %s for %d articles", batch.id, len(articles))
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(POLL_INTERVAL)
+        batch = await oai_client.batches.retrieve(batch.id)
+
+    if batch.status != "completed":
+        log.error(
+            "Summary batch %s ended in state %s, will retry", batch.id, batch.status
+        )
+        return
+
+    output = await oai_client.files.content(batch.output_file_id)
+    await save_summaries(output.text)
+    log.info("Summary batch %s done", batch.id)
+
+
+async def summary_worker(oai_client: AsyncOpenAI):
+    """
+    Background task filling in `Article.summary` for newly generated articles.
+    Runs for the lifetime of the app; one batch is in flight at a time.
+    """
+    while True:
+        try:
+            articles = await pending_articles()
+            if articles:
+                await run_batch(oai_client, articles)
+        except asyncio.CancelledError:
+            raise
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Summary batch failed, will retry")
+        await asyncio.sleep(BATCH_INTERVAL)